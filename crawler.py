@@ -1,13 +1,18 @@
 from __future__ import print_function
+import os
 import sys
 import time
-from threading import Thread, Event, Lock
+import cProfile
+import pstats
+from contextlib import contextmanager
+from threading import Thread, Event, Lock, current_thread
+from timeit import default_timer
 from argparse import ArgumentParser
 from requests.utils import urlparse, urlunparse
 from requests.compat import urljoin
 import requests
 import logging
-from collections import defaultdict
+from collections import defaultdict, Counter
 from bs4 import BeautifulSoup
 
 IS_PY2 = sys.version_info < (3, 0)
@@ -17,6 +22,13 @@ if IS_PY2:
 else:
     from urllib.robotparser import RobotFileParser
 
+# per thread cpu clock (python 3.7+), without it cpu time is not recorded
+thread_time = getattr(time, 'thread_time', None)
+
+# cProfile uses sys.monitoring since python 3.12, single profiler enabled in
+# any thread profiles all threads and only one can be active at a time.
+PROCESS_WIDE_CPROFILE = sys.version_info >= (3, 12)
+
 
 logging.basicConfig(filename='error.log', filemode='w')
 
@@ -28,6 +40,323 @@ FILE_CONTENTS = (".epub", ".mobi", ".docx", ".doc", ".opf", ".7z",
 lock = Lock()
 
 
+def get_robot_parser(root_url):
+    """
+    Downloads robots.txt of domain.
+
+    :param root_url: parsed url of domain
+    :return: RobotFileParser
+    """
+    robots_url = urljoin(
+        '{}://{}'.format(root_url.scheme, root_url.netloc),
+        "robots.txt")
+    rp = RobotFileParser()
+    rp.set_url(robots_url)
+    rp.read()
+    return rp
+
+
+class _NullStage(object):
+    """
+    Stage returned when profiling is disabled, it records nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def split_off(self, stage, elapsed):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """
+    Measures wall and cpu time of a single stage and reports it to profiler.
+    """
+    def __init__(self, profiler, worker, name, error=None):
+        self.profiler = profiler
+        self.worker = worker
+        self.name = name
+        self.error = error
+        self._splits = []
+
+    def __enter__(self):
+        self._wall = default_timer()
+        self._cpu = thread_time() if thread_time else 0.0
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        wall = default_timer() - self._wall
+        cpu = thread_time() - self._cpu if thread_time else 0.0
+        if exc_type is not None and self.error is not None:
+            # whole failed stage is reported as error stage
+            self.profiler.record(self.worker, self.error, wall, cpu)
+            return False
+
+        for stage, elapsed in self._splits:
+            elapsed = min(elapsed, wall)
+            wall -= elapsed
+            self.profiler.record(self.worker, stage, elapsed, 0.0)
+        self.profiler.record(self.worker, self.name, wall, cpu)
+        return False
+
+    def split_off(self, stage, elapsed):
+        """
+        Moves part of the wall time of this stage to another stage.
+        ex. time until response headers arrived (requests' elapsed) is
+        reported as connect and rest of the fetch as transfer.
+
+        :param stage: Stage name which will be credited with elapsed time.
+        :param elapsed: timedelta or seconds to move.
+        :return:
+        """
+        if hasattr(elapsed, 'total_seconds'):
+            elapsed = elapsed.total_seconds()
+        self._splits.append((stage, elapsed))
+
+
+class Profiler(object):
+    """
+    Aggregates wall and cpu time spent in each crawl stage per worker and
+    optionally samples workers with cProfile or a statistical stack sampler.
+
+    Stages:
+        idle        - waiting for urls to crawl (once per idle period)
+        lock_wait   - waiting for shared lock to save found urls
+        connect     - dns, connect and waiting for response headers
+        transfer    - reading response body
+        error       - failed requests (dns error, refused, timeout)
+        parse       - BeautifulSoup parsing
+        prepare_url - PageCrawler.prepare_url
+        can_fetch   - PageCrawler.can_fetch (robots.txt)
+
+    cpu time is per thread cpu time, it's not available (shown as n/a)
+    on python older than 3.7 as time.thread_time is missing.
+    """
+    STAGES = ('idle', 'lock_wait', 'connect', 'transfer', 'error', 'parse',
+              'prepare_url', 'can_fetch')
+
+    SAMPLERS = ('cprofile', 'stack')
+
+    DEFAULT_OUTPUT = {'cprofile': 'crawler.prof', 'stack': 'crawler.stacks'}
+
+    def __init__(self, sampler=None, output=None, interval=0.005):
+        if sampler is not None and sampler not in self.SAMPLERS:
+            raise ValueError("Invalid sampler {}".format(sampler))
+
+        self.sampler = sampler
+        self.output = output or self.DEFAULT_OUTPUT.get(sampler)
+        self.interval = interval
+
+        # callables called as hook(worker, stage, wall, cpu)
+        self.hooks = []
+
+        # worker => stage => [calls, wall, cpu]
+        self.stats = defaultdict(lambda: defaultdict(lambda: [0, 0.0, 0.0]))
+
+        self._lock = Lock()
+        self._profiles = []
+        self._profile = None
+        self._written = False
+        self._threads = {}
+        self._samples = Counter()
+        self._sampler_stopped = Event()
+        self._sampler_thread = None
+
+    def add_hook(self, hook):
+        """
+        Register callable which is called after each stage as
+        hook(worker, stage, wall, cpu).
+
+        :param hook: callable
+        :return:
+        """
+        self.hooks.append(hook)
+
+    def stage(self, name, worker=None, error=None):
+        """
+        Returns context manager which times the enclosed block as stage.
+
+        :param name: stage name
+        :param worker: worker name (defaults to current thread name)
+        :param error: stage name to report block as if it raises
+        :return: context manager
+        """
+        if worker is None:
+            worker = current_thread().name
+        return _Stage(self, worker, name, error)
+
+    def record(self, worker, stage, wall, cpu):
+        """
+        Adds timing of one stage run to worker stats and calls hooks.
+        """
+        with self._lock:
+            stat = self.stats[worker][stage]
+            stat[0] += 1
+            stat[1] += wall
+            stat[2] += cpu
+
+        for hook in self.hooks:
+            hook(worker, stage, wall, cpu)
+
+    def start(self):
+        """
+        Starts statistical sampler thread (if stack sampler is selected) or
+        process wide cProfile (if supported by python).
+        :return:
+        """
+        if self.sampler == 'cprofile' and PROCESS_WIDE_CPROFILE:
+            self._profile = self._enable_cprofile()
+
+        elif self.sampler == 'stack':
+            self._sampler_stopped.clear()
+            self._sampler_thread = Thread(target=self._sample,
+                                          name='profiler-sampler')
+            self._sampler_thread.daemon = True
+            self._sampler_thread.start()
+
+    def stop(self):
+        """
+        Stops sampler and writes collected samples to output file.
+        :return:
+        """
+        if self._sampler_thread is not None:
+            self._sampler_stopped.set()
+            self._sampler_thread.join()
+            self._sampler_thread = None
+
+        if self._profile is not None:
+            self._profile.disable()
+            self._profiles.append(self._profile)
+            self._profile = None
+
+        if self.sampler == 'cprofile' and self._profiles:
+            stats = pstats.Stats(self._profiles[0])
+            for profile in self._profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(self.output)
+            self._written = True
+
+        elif self.sampler == 'stack' and self._samples:
+            # collapsed stacks format understood by flamegraph.pl/speedscope
+            with open(self.output, 'w') as f:
+                for stack, count in sorted(self._samples.items()):
+                    f.write('{} {}\n'.format(stack, count))
+            self._written = True
+
+    def worker_started(self):
+        """
+        Must be called from worker thread before it starts crawling.
+        :return: cProfile.Profile if cprofile sampler is selected else None.
+        """
+        thread = current_thread()
+        with self._lock:
+            self._threads[thread.ident] = thread.name
+
+        if self.sampler == 'cprofile' and not PROCESS_WIDE_CPROFILE:
+            return self._enable_cprofile()
+        return None
+
+    @staticmethod
+    def _enable_cprofile():
+        """
+        :return: enabled cProfile.Profile or None if another profiler is
+        already active.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            logging.warning("cprofile sampler disabled, another profiling "
+                            "tool is already active")
+            return None
+        return profile
+
+    def worker_stopped(self, profile=None):
+        """
+        Must be called from worker thread after it stops crawling.
+
+        :param profile: value returned by worker_started.
+        :return:
+        """
+        if profile is not None:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
+
+        with self._lock:
+            self._threads.pop(current_thread().ident, None)
+
+    def _sample(self):
+        """
+        Periodically records stacks of all registered worker threads.
+        :return:
+        """
+        while not self._sampler_stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self._threads.items())
+
+            for ident, name in threads:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                if stack:
+                    stack.append(name)
+                    self._samples[';'.join(reversed(stack))] += 1
+
+    def summary(self):
+        """
+        Aggregates stats of all workers.
+
+        :return: list of (stage, calls, wall, cpu, max worker wall) sorted
+        by wall time.
+        """
+        totals = {}
+        with self._lock:
+            for worker, stages in self.stats.items():
+                for stage, (calls, wall, cpu) in stages.items():
+                    total = totals.setdefault(stage, [stage, 0, 0.0, 0.0, 0.0])
+                    total[1] += calls
+                    total[2] += wall
+                    total[3] += cpu
+                    total[4] = max(total[4], wall)
+
+        return sorted((tuple(t) for t in totals.values()),
+                      key=lambda t: t[2], reverse=True)
+
+    def print_summary(self):
+        """
+        This prints table of time spent in each stage.
+        :return:
+        """
+        rows = self.summary()
+        total_wall = sum(row[2] for row in rows) or 1.0
+
+        print('\nProfile summary ({} workers)'.format(len(self.stats)),
+              end='\n\n')
+        print('{:<12} {:>10} {:>12} {:>12} {:>7} {:>14}'.format(
+            'stage', 'calls', 'wall(s)', 'cpu(s)', 'wall%', 'max worker(s)'))
+        for stage, calls, wall, cpu, worker_wall in rows:
+            cpu = '{:.3f}'.format(cpu) if thread_time else 'n/a'
+            print('{:<12} {:>10} {:>12.3f} {:>12} {:>6.1f}% {:>14.3f}'
+                  .format(stage, calls, wall, cpu, wall * 100 / total_wall,
+                          worker_wall))
+
+        if self._written:
+            print('\n{} profile written to {}'.format(self.sampler,
+                                                      self.output))
+
+
 class Sitemap(object):
     def __init__(self, urls):
         self.urls = urls
@@ -114,7 +443,8 @@ class Sitemap(object):
 
 class PageCrawler(Thread):
     def __init__(self, root_url, todo_urls, crawled_urls, urls_found,
-                 stop_crawler_event, query=False, fragment=False, robot_parser=None):
+                 stop_crawler_event, query=False, fragment=False, robot_parser=None,
+                 profiler=None):
         Thread.__init__(self)
         self.root_url = root_url
         self.todo_urls = todo_urls
@@ -124,6 +454,7 @@ class PageCrawler(Thread):
         self.query = query
         self.fragment = fragment
         self.robot_parser = robot_parser
+        self.profiler = profiler
         self._waiting = False
 
     @property
@@ -134,28 +465,76 @@ class PageCrawler(Thread):
         """
         return self._waiting
 
+    def _stage(self, name, error=None):
+        """
+        Returns context manager timing the enclosed block as profiler stage.
+
+        :param name: stage name
+        :param error: stage name to report block as if it raises
+        :return: context manager
+        """
+        if self.profiler is None:
+            return _NULL_STAGE
+        return self.profiler.stage(name, self.name, error)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Acquires shared lock, time spent waiting is reported as lock_wait.
+        :return:
+        """
+        with self._stage('lock_wait'):
+            lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
     def run(self):
         """
         This method loop until stop_crawler_event is set.
         Get url from todo urls => download page => extract urls and repeat.
         :return:
         """
-        while not self.stop_crawler_event.is_set():
-            try:
-                with lock:
-                    url = self.todo_urls.pop()
-                    self._waiting = False
-            except KeyError:
-                self._waiting = True
-            else:
-                if url in self.crawled_urls:
-                    continue
+        profile = None
+        try:
+            if self.profiler is not None:
+                profile = self.profiler.worker_started()
+            self._crawl()
+        finally:
+            if self.profiler is not None:
+                self.profiler.worker_stopped(profile)
+
+    def _crawl(self):
+        # timed from first failed pop until url is available again
+        idle = None
+        try:
+            while not self.stop_crawler_event.is_set():
+                try:
+                    with lock:
+                        url = self.todo_urls.pop()
+                        self._waiting = False
+                except KeyError:
+                    self._waiting = True
+                    if idle is None:
+                        idle = self._stage('idle')
+                        idle.__enter__()
+                else:
+                    if idle is not None:
+                        idle.__exit__(None, None, None)
+                        idle = None
 
-                res = self.get_page_html(url)
+                    if url in self.crawled_urls:
+                        continue
 
-                self.crawled_urls.add(url)
-                if res:
-                    self.extract_urls(url, res.text)
+                    res = self.get_page_html(url)
+
+                    self.crawled_urls.add(url)
+                    if res:
+                        self.extract_urls(url, res.text)
+        finally:
+            if idle is not None:
+                idle.__exit__(None, None, None)
 
     @staticmethod
     def _get_page(url):
@@ -175,7 +554,9 @@ class PageCrawler(Thread):
         else None in case of unsuccessful response or exception.
         """
         try:
-            res = self._get_page(url)
+            with self._stage('transfer', error='error') as stage:
+                res = self._get_page(url)
+                stage.split_off('connect', res.elapsed)
             if 299 >= res.status_code >= 200:
                 return res
             return None
@@ -297,16 +678,9 @@ class PageCrawler(Thread):
         :return: None
         """
         if html:
-            soup = BeautifulSoup(html, "html.parser")
-            for a in soup.find_all('a', href=True):
-                raw_link = a['href']
-                link = self.prepare_url(current_url, raw_link)
-
-                if not self.can_fetch(link):
-                    continue
-
-                if link and link not in self.crawled_urls:
-                    with lock:
+            for link in self.find_urls(current_url, html):
+                if link not in self.crawled_urls:
+                    with self._locked():
                         self.todo_urls.add(link)
                         self.urls_found.add(link)
 
@@ -314,6 +688,36 @@ class PageCrawler(Thread):
                 len(self.urls_found), len(self.crawled_urls),
                 len(self.todo_urls)))
 
+    def find_urls(self, current_url, html):
+        """
+        Generates urls from html page which belong to same domain and are
+        allowed by robots.txt
+
+        :param current_url: page url from which urls need to be extracted.
+        :param html: actual page html to crawl for urls.
+        :return: generator of absolute urls (see prepare_url)
+        """
+        with self._stage('parse'):
+            soup = BeautifulSoup(html, "html.parser")
+            anchors = soup.find_all('a', href=True)
+
+        for a in anchors:
+            raw_link = a['href']
+            with self._stage('prepare_url'):
+                try:
+                    link = self.prepare_url(current_url, raw_link)
+                except ValueError:
+                    # malformed url ex. http://[oops (invalid IPv6)
+                    logging.warning("invalid url {} on page {}".format(
+                        raw_link, current_url))
+                    continue
+
+            with self._stage('can_fetch'):
+                allowed = self.can_fetch(link)
+
+            if allowed and link:
+                yield link
+
     def can_fetch(self, link):
         if self.robot_parser:
             try:
@@ -328,7 +732,8 @@ class PageCrawler(Thread):
 
 class Crawler(object):
     def __init__(self, domain, limit=1000, jobs=16, query=False,
-                 fragment=False, fallback_scheme='http'):
+                 fragment=False, fallback_scheme='http', profile=False,
+                 profile_sampler=None, profile_output=None):
 
         self.limit = limit
 
@@ -357,6 +762,12 @@ class Crawler(object):
 
         self.rp = None
 
+        # collects per stage timings of crawler threads
+        self.profiler = None
+        if profile or profile_sampler:
+            self.profiler = Profiler(sampler=profile_sampler,
+                                     output=profile_output)
+
     @property
     def urls_found(self):
         """
@@ -375,6 +786,9 @@ class Crawler(object):
         """
         self.get_real_domain()
         self.get_robot_txt()
+        if self.profiler:
+            self.profiler.start()
+
         for i in range(0, self.jobs):
             t = PageCrawler(self.root_url,
                             self.todo_urls,
@@ -383,7 +797,8 @@ class Crawler(object):
                             self.stop_crawler_event,
                             self.query,
                             self.fragment,
-                            self.rp
+                            self.rp,
+                            self.profiler
                             )
 
             self.crawler_jobs.append(t)
@@ -398,6 +813,10 @@ class Crawler(object):
         for job in self.crawler_jobs:
             job.join()
 
+        if self.profiler:
+            self.profiler.stop()
+            self.profiler.print_summary()
+
     def is_finished(self):
         """
         This will return true if site map completion condition is reached.
@@ -493,12 +912,7 @@ class Crawler(object):
         self.todo_urls.add(new_url)
 
     def get_robot_txt(self):
-        robots_url = urljoin(
-            '{}://{}'.format(self.root_url.scheme, self.root_url.netloc),
-            "robots.txt")
-        self.rp = RobotFileParser()
-        self.rp.set_url(robots_url)
-        self.rp.read()
+        self.rp = get_robot_parser(self.root_url)
 
 if __name__ == '__main__':
 
@@ -526,6 +940,21 @@ if __name__ == '__main__':
                         default=False, help="prints result as plain urls"
                                             "instead of tree")
 
+    parser.add_argument('--profile', action="store_true", default=False,
+                        help="print time spent in each crawl stage (connect, "
+                             "transfer, parse, prepare_url, can_fetch, "
+                             "lock_wait)")
+
+    parser.add_argument('--profile-sampler', action="store", default=None,
+                        choices=Profiler.SAMPLERS,
+                        help="also sample crawler threads with cProfile "
+                             "(pstats file) or stack sampler (collapsed "
+                             "stacks for flamegraph), implies --profile")
+
+    parser.add_argument('--profile-output', action="store", default=None,
+                        help="file to write sampler output to (default "
+                             "crawler.prof or crawler.stacks)")
+
     args = vars(parser.parse_args())
 
     plain = args.pop('plain')
@@ -0,0 +1,888 @@
+from __future__ import print_function
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import zlib
+import base64
+import socket
+import sqlite3
+import logging
+from threading import Thread, Event, Lock
+from argparse import ArgumentParser
+from requests.utils import urlparse
+from requests.compat import quote
+import requests
+from crawler import Crawler, PageCrawler, Sitemap, get_robot_parser
+
+IS_PY2 = sys.version_info < (3, 0)
+
+if IS_PY2:
+    from SocketServer import ThreadingMixIn
+    from SimpleXMLRPCServer import (SimpleXMLRPCServer,
+                                    SimpleXMLRPCRequestHandler)
+    from xmlrpclib import ServerProxy, ProtocolError, Fault
+else:
+    from socketserver import ThreadingMixIn
+    from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+    from xmlrpc.client import ServerProxy, ProtocolError, Fault
+
+
+# url states in frontier
+PENDING, LEASED, DONE = 0, 1, 2
+
+# max active leases per partition. crawler only follows urls of root domain
+# so all urls share one partition and this is the number of batches crawled
+# at once by whole cluster (same as default jobs of single Crawler).
+DEFAULT_HOST_CONCURRENCY = 16
+
+# leases of url which expire these many times (worker dies or hangs on it)
+# are not reassigned again, url is marked as crawled.
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def host_partition(url, partitions):
+    """
+    Returns frontier partition of url. All urls of same host share partition
+    so number of workers crawling one host at once can be limited.
+
+    zlib.crc32 is used instead of hash() as it's stable across processes.
+
+    :param url: absolute url
+    :param partitions: total number of partitions
+    :return: partition number
+    """
+    netloc = urlparse(url).netloc.lower()
+    return (zlib.crc32(netloc.encode('utf-8')) & 0xffffffff) % partitions
+
+
+class SqliteFrontier(object):
+    """
+    Frontier and dedup store kept in sqlite database.
+
+    Each url is stored once (dedup), pending urls are leased to workers in
+    batches taken from single partition and at most host_concurrency leases
+    are active per partition at once.
+
+    Number of found and pending urls is kept in memory as counting rows
+    scans whole table.
+    """
+    def __init__(self, path=':memory:', partitions=64,
+                 host_concurrency=DEFAULT_HOST_CONCURRENCY,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.partitions = partitions
+        self.host_concurrency = host_concurrency
+        self.max_attempts = max_attempts
+
+        # coordinator serializes access, connection is used from rpc threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT UNIQUE NOT NULL,
+                part INTEGER NOT NULL,
+                state INTEGER NOT NULL DEFAULT 0,
+                lease_id TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS urls_state ON urls (state, part);
+            CREATE INDEX IF NOT EXISTS urls_lease ON urls (lease_id);
+            CREATE TABLE IF NOT EXISTS leases (
+                lease_id TEXT PRIMARY KEY,
+                worker TEXT NOT NULL,
+                part INTEGER NOT NULL,
+                expires REAL NOT NULL
+            );
+        """)
+
+        # counted once, existing database is resumed
+        self._found = self.db.execute(
+            "SELECT COUNT(*) FROM urls").fetchone()[0]
+        self._pending = self.db.execute(
+            "SELECT COUNT(*) FROM urls WHERE state = ?",
+            (PENDING,)).fetchone()[0]
+
+    def add(self, urls, max_new=None):
+        """
+        Adds urls which were never seen before to frontier.
+
+        :param urls: urls to add
+        :param max_new: stop after these many new urls are added
+        :return: number of new urls added
+        """
+        added = 0
+        for url in urls:
+            if max_new is not None and added >= max_new:
+                break
+            cur = self.db.execute(
+                "INSERT OR IGNORE INTO urls (url, part) VALUES (?, ?)",
+                (url, host_partition(url, self.partitions)))
+            added += cur.rowcount
+        self.db.commit()
+        self._found += added
+        self._pending += added
+        return added
+
+    def lease(self, worker, batch_size, ttl):
+        """
+        Leases batch of pending urls of one partition to worker.
+
+        :param worker: worker id
+        :param batch_size: max number of urls in batch
+        :param ttl: seconds after which lease expires
+        :return: (lease_id, urls) or (None, []) if nothing can be leased.
+        """
+        row = self.db.execute(
+            "SELECT part FROM urls WHERE state = ? AND part NOT IN ("
+            "  SELECT part FROM leases GROUP BY part HAVING COUNT(*) >= ?"
+            ") ORDER BY id LIMIT 1",
+            (PENDING, self.host_concurrency)).fetchone()
+        if row is None:
+            return None, []
+
+        part = row[0]
+        rows = self.db.execute(
+            "SELECT id, url FROM urls WHERE state = ? AND part = ? "
+            "ORDER BY id LIMIT ?", (PENDING, part, batch_size)).fetchall()
+
+        lease_id = uuid.uuid4().hex
+        self.db.executemany(
+            "UPDATE urls SET state = ?, lease_id = ? WHERE id = ?",
+            [(LEASED, lease_id, _id) for _id, _ in rows])
+        self.db.execute(
+            "INSERT INTO leases (lease_id, worker, part, expires) "
+            "VALUES (?, ?, ?, ?)", (lease_id, worker, part, time.time() + ttl))
+        self.db.commit()
+        self._pending -= len(rows)
+        return lease_id, [url for _, url in rows]
+
+    def complete(self, lease_id):
+        """
+        Marks urls of lease as crawled.
+
+        :param lease_id: lease to complete
+        :return: False if lease is unknown (ex. expired and reassigned)
+        """
+        cur = self.db.execute("DELETE FROM leases WHERE lease_id = ?",
+                              (lease_id,))
+        if cur.rowcount == 0:
+            self.db.commit()
+            return False
+
+        self.db.execute(
+            "UPDATE urls SET state = ?, lease_id = NULL WHERE lease_id = ?",
+            (DONE, lease_id))
+        self.db.commit()
+        return True
+
+    def renew(self, lease_id, ttl):
+        """
+        Extends lease of worker which is still crawling its batch.
+
+        :param lease_id: lease to renew
+        :param ttl: seconds from now after which lease expires
+        :return: False if lease is unknown (ex. expired and reassigned)
+        """
+        cur = self.db.execute("UPDATE leases SET expires = ? "
+                              "WHERE lease_id = ?",
+                              (time.time() + ttl, lease_id))
+        self.db.commit()
+        return cur.rowcount > 0
+
+    def reclaim(self):
+        """
+        Returns urls of expired leases to pending so they can be reassigned,
+        urls whose leases expired max_attempts times are marked as crawled.
+
+        :return: number of expired leases
+        """
+        expired = [row[0] for row in self.db.execute(
+            "SELECT lease_id FROM leases WHERE expires <= ?", (time.time(),))]
+        for lease_id in expired:
+            abandoned = [row[0] for row in self.db.execute(
+                "SELECT url FROM urls "
+                "WHERE lease_id = ? AND attempts + 1 >= ?",
+                (lease_id, self.max_attempts))]
+            if abandoned:
+                logging.warning("giving up on urls after {} attempts: {}"
+                                .format(self.max_attempts, abandoned))
+
+            cur = self.db.execute(
+                "UPDATE urls SET attempts = attempts + 1, lease_id = NULL, "
+                "state = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END "
+                "WHERE lease_id = ?",
+                (self.max_attempts, DONE, PENDING, lease_id))
+            self._pending += cur.rowcount - len(abandoned)
+            self.db.execute("DELETE FROM leases WHERE lease_id = ?",
+                            (lease_id,))
+        self.db.commit()
+        return len(expired)
+
+    def found(self):
+        return self._found
+
+    def pending(self):
+        return self._pending
+
+    def leased(self):
+        return self.db.execute("SELECT COUNT(*) FROM leases").fetchone()[0]
+
+    def urls(self):
+        """
+        :return: list of all found urls in order they were found.
+        """
+        return [row[0] for row in
+                self.db.execute("SELECT url FROM urls ORDER BY id")]
+
+
+class RedisFrontier(object):
+    """
+    Frontier and dedup store kept in redis (or any server/client speaking
+    redis protocol ex. fakeredis) so it survives coordinator restart.
+
+    Keys (prefixed with prefix):
+        seen        - set of all found urls (dedup)
+        found       - list of all found urls in order they were found
+        pending:<n> - list of pending urls of partition n
+        ready       - set of partitions having pending urls
+        active      - hash partition => number of active leases
+        leases      - hash lease_id => json lease
+        attempts    - hash url => number of times its lease expired
+    """
+    def __init__(self, client, prefix='crawler', partitions=64,
+                 host_concurrency=DEFAULT_HOST_CONCURRENCY,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.client = client
+        self.prefix = prefix
+        self.partitions = partitions
+        self.host_concurrency = host_concurrency
+        self.max_attempts = max_attempts
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + tuple(str(p) for p in parts))
+
+    @staticmethod
+    def _decode(value):
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        return value
+
+    def add(self, urls, max_new=None):
+        added = 0
+        for url in urls:
+            if max_new is not None and added >= max_new:
+                break
+            if not self.client.sadd(self._key('seen'), url):
+                continue
+            part = host_partition(url, self.partitions)
+            self.client.rpush(self._key('found'), url)
+            self.client.rpush(self._key('pending', part), url)
+            self.client.sadd(self._key('ready'), part)
+            added += 1
+        return added
+
+    def lease(self, worker, batch_size, ttl):
+        active = self.client.hgetall(self._key('active'))
+        active = dict((int(self._decode(k)), int(v))
+                      for k, v in active.items())
+
+        for part in sorted(int(self._decode(p)) for p in
+                           self.client.smembers(self._key('ready'))):
+            if active.get(part, 0) >= self.host_concurrency:
+                continue
+
+            urls = []
+            while len(urls) < batch_size:
+                url = self.client.lpop(self._key('pending', part))
+                if url is None:
+                    break
+                urls.append(self._decode(url))
+
+            if not self.client.llen(self._key('pending', part)):
+                self.client.srem(self._key('ready'), part)
+
+            if not urls:
+                continue
+
+            lease_id = uuid.uuid4().hex
+            self.client.hset(self._key('leases'), lease_id, json.dumps({
+                'worker': worker, 'part': part, 'urls': urls,
+                'expires': time.time() + ttl}))
+            self.client.hincrby(self._key('active'), part, 1)
+            return lease_id, urls
+
+        return None, []
+
+    def complete(self, lease_id):
+        lease = self.client.hget(self._key('leases'), lease_id)
+        if lease is None:
+            return False
+
+        lease = json.loads(self._decode(lease))
+        self.client.hdel(self._key('leases'), lease_id)
+        self.client.hincrby(self._key('active'), lease['part'], -1)
+        return True
+
+    def renew(self, lease_id, ttl):
+        lease = self.client.hget(self._key('leases'), lease_id)
+        if lease is None:
+            return False
+
+        lease = json.loads(self._decode(lease))
+        lease['expires'] = time.time() + ttl
+        self.client.hset(self._key('leases'), lease_id, json.dumps(lease))
+        return True
+
+    def reclaim(self):
+        expired = 0
+        now = time.time()
+        leases = self.client.hgetall(self._key('leases'))
+        for lease_id, lease in leases.items():
+            lease = json.loads(self._decode(lease))
+            if lease['expires'] > now:
+                continue
+
+            part = lease['part']
+            abandoned = []
+            # put urls back in front so they are leased first
+            for url in reversed(lease['urls']):
+                attempts = self.client.hincrby(self._key('attempts'), url, 1)
+                if attempts >= self.max_attempts:
+                    abandoned.append(url)
+                    continue
+                self.client.lpush(self._key('pending', part), url)
+                self.client.sadd(self._key('ready'), part)
+
+            if abandoned:
+                logging.warning("giving up on urls after {} attempts: {}"
+                                .format(self.max_attempts, abandoned))
+            self.client.hincrby(self._key('active'), part, -1)
+            self.client.hdel(self._key('leases'), lease_id)
+            expired += 1
+        return expired
+
+    def found(self):
+        return self.client.llen(self._key('found'))
+
+    def pending(self):
+        return sum(self.client.llen(self._key('pending', self._decode(p)))
+                   for p in self.client.smembers(self._key('ready')))
+
+    def leased(self):
+        return self.client.hlen(self._key('leases'))
+
+    def urls(self):
+        return [self._decode(url) for url in
+                self.client.lrange(self._key('found'), 0, -1)]
+
+
+def get_frontier(backend=':memory:', partitions=64,
+                 host_concurrency=DEFAULT_HOST_CONCURRENCY,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Creates frontier from backend string.
+
+    ex. ':memory:', 'crawl.db' => SqliteFrontier
+        'redis://localhost:6379/0' => RedisFrontier (needs redis package)
+
+    :return: frontier
+    """
+    if backend.startswith(('redis://', 'rediss://', 'unix://')):
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("redis package is required for backend {}"
+                             .format(backend))
+        return RedisFrontier(redis.StrictRedis.from_url(backend),
+                             partitions=partitions,
+                             host_concurrency=host_concurrency,
+                             max_attempts=max_attempts)
+
+    return SqliteFrontier(backend, partitions=partitions,
+                          host_concurrency=host_concurrency,
+                          max_attempts=max_attempts)
+
+
+def get_proxy(url, token=None):
+    """
+    Returns xml-rpc proxy of coordinator, token is sent as basic auth
+    password.
+
+    :param url: coordinator url (ex. http://10.0.0.1:8000)
+    :param token: shared token coordinator was started with
+    :return: ServerProxy
+    """
+    if token:
+        url = urlparse(url)
+        url = url._replace(netloc=':{}@{}'.format(quote(token, safe=''),
+                                                  url.netloc)).geturl()
+    return ServerProxy(url)
+
+
+class _RPCRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    Rejects requests without server token (if server has token).
+    """
+    def parse_request(self):
+        if not SimpleXMLRPCRequestHandler.parse_request(self):
+            return False
+
+        if self.server.token and not self._has_token(self.server.token):
+            self.send_error(401, "Unauthorized")
+            return False
+        return True
+
+    def _has_token(self, token):
+        auth = self.headers.get('Authorization', '')
+        try:
+            credentials = base64.b64decode(auth.split(' ', 1)[-1])
+        except (TypeError, ValueError):
+            return False
+        password = credentials.partition(b':')[2]
+        return hmac.compare_digest(password, token.encode('utf-8'))
+
+
+class _RPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+    token = None
+
+
+class Coordinator(object):
+    """
+    Owns frontier and serves url batches to workers over xml-rpc.
+
+    rpc methods:
+        config() => crawl settings for workers
+        lease(worker_id, batch_size) => {lease_id, urls, finished}
+        renew(lease_id) => False if lease had expired
+        complete(lease_id, outlinks) => False if lease had expired
+
+    xml-rpc is not authenticated nor safe against malicious data, bind it to
+    private interface and set token so only workers knowing it are served.
+    """
+    def __init__(self, domain, limit=1000, query=False, fragment=False,
+                 fallback_scheme='http', frontier=None, host='127.0.0.1',
+                 port=8000, lease_ttl=60, batch_size=10, token=None,
+                 finish_grace=2):
+
+        # crawler is used to resolve root url and seed frontier
+        self.crawler = Crawler(domain, limit=limit, query=query,
+                               fragment=fragment,
+                               fallback_scheme=fallback_scheme)
+
+        self.limit = limit
+
+        self.frontier = frontier or SqliteFrontier()
+
+        self.address = (host, port)
+
+        self.lease_ttl = lease_ttl
+
+        self.batch_size = batch_size
+
+        self.token = token
+
+        # seconds rpc server keeps telling polling workers crawl is finished
+        self.finish_grace = finish_grace
+
+        self.server = None
+
+        self.stop_coordinator_event = Event()
+
+        self._lock = Lock()
+
+    @property
+    def url(self):
+        """
+        Url workers connect to (available after bind).
+        """
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def urls_found(self):
+        """
+        This returns list of found urls.
+        :return: list of urls
+        """
+        urls = self.frontier.urls()
+        if self.limit < 0:
+            return urls
+        return urls[:self.limit]
+
+    def bind(self):
+        """
+        Creates rpc server listening on address (use port 0 for any free
+        port).
+        :return:
+        """
+        self.server = _RPCServer(self.address,
+                                 requestHandler=_RPCRequestHandler,
+                                 logRequests=False)
+        self.server.token = self.token
+        self.server.register_function(self.config, 'config')
+        self.server.register_function(self.lease, 'lease')
+        self.server.register_function(self.renew, 'renew')
+        self.server.register_function(self.complete, 'complete')
+
+    def start(self):
+        """
+        Seeds frontier and serves workers until crawl is finished.
+        :return:
+        """
+        self.crawler.get_real_domain()
+        with self._lock:
+            self._add(self.crawler.urls_found)
+
+        if self.server is None:
+            self.bind()
+
+        server_thread = Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        while not self.stop_coordinator_event.is_set():
+            time.sleep(0.1)
+            with self._lock:
+                self.frontier.reclaim()
+                if self.is_finished():
+                    self.stop_coordinator_event.set()
+
+        time.sleep(self.finish_grace)
+        self.server.shutdown()
+        self.server.server_close()
+        server_thread.join()
+
+    def is_finished(self):
+        """
+        This will return true if site map completion condition is reached.
+        :return:
+        """
+        if 0 <= self.limit <= self.frontier.found():
+            return True
+
+        return self.frontier.pending() == 0 and self.frontier.leased() == 0
+
+    def _add(self, urls):
+        if self.limit < 0:
+            self.frontier.add(urls)
+        else:
+            remaining = self.limit - self.frontier.found()
+            if remaining > 0:
+                self.frontier.add(urls, max_new=remaining)
+
+    def config(self):
+        root_url = self.crawler.root_url
+        return {'root_url': root_url.geturl(),
+                'query': self.crawler.query,
+                'fragment': self.crawler.fragment,
+                'lease_ttl': self.lease_ttl}
+
+    def lease(self, worker_id, batch_size=0):
+        with self._lock:
+            self.frontier.reclaim()
+            if self.is_finished():
+                self.stop_coordinator_event.set()
+                return {'lease_id': '', 'urls': [], 'finished': True}
+
+            lease_id, urls = self.frontier.lease(
+                worker_id, batch_size or self.batch_size, self.lease_ttl)
+            return {'lease_id': lease_id or '', 'urls': urls,
+                    'finished': False}
+
+    def renew(self, lease_id):
+        with self._lock:
+            return self.frontier.renew(lease_id, self.lease_ttl)
+
+    def complete(self, lease_id, outlinks):
+        with self._lock:
+            completed = self.frontier.complete(lease_id)
+            self._add(outlinks)
+
+            print('urls found: {}, urls to visit: {}, active leases: {}'
+                  .format(self.frontier.found(), self.frontier.pending(),
+                          self.frontier.leased()))
+            return completed
+
+
+class LeaseCrawler(PageCrawler):
+    """
+    Crawler thread which gets urls in batches from coordinator and returns
+    urls found on those pages. Lease is renewed after each url so batch of
+    live worker is not reassigned.
+
+    Rpc calls are retried while coordinator is unreachable (ex. restarted)
+    for at most retry_timeout seconds, then whole worker stops.
+    """
+    def __init__(self, coordinator_url, worker_id, root_url,
+                 stop_crawler_event, query=False, fragment=False,
+                 robot_parser=None, batch_size=0, poll_interval=0.5,
+                 timeout=30, token=None, retry_timeout=60,
+                 retry_interval=0.5):
+        PageCrawler.__init__(self, root_url, set(), set(), set(),
+                             stop_crawler_event, query, fragment, robot_parser)
+        self.coordinator = get_proxy(coordinator_url, token)
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.retry_timeout = retry_timeout
+        self.retry_interval = retry_interval
+
+    def _get_page(self, url):
+        """
+        Gets response from internet, waits at most timeout seconds for
+        server so lease can be renewed in time.
+
+        :param url: Url to fetch
+        :return: Returns response object if request was successful.
+        """
+        return requests.get(url, timeout=self.timeout)
+
+    def _call(self, method, *args):
+        """
+        Calls coordinator rpc method, retries with exponential backoff while
+        coordinator is unreachable.
+
+        :param method: rpc method name
+        :param args: rpc method arguments
+        :return: rpc result
+        """
+        deadline = time.time() + self.retry_timeout
+        delay = self.retry_interval
+        while True:
+            try:
+                return getattr(self.coordinator, method)(*args)
+            except (socket.error, ProtocolError) as e:
+                # client errors (ex. 401 wrong token) won't go away
+                if isinstance(e, ProtocolError) and e.errcode < 500:
+                    raise
+
+                remaining = deadline - time.time()
+                if remaining <= 0 or self.stop_crawler_event.is_set():
+                    raise
+
+                logging.warning("coordinator unreachable ({}), retrying"
+                                .format(e))
+                self.stop_crawler_event.wait(min(delay, remaining))
+                delay = min(delay * 2, 10)
+
+    def _crawl_lease(self, lease):
+        """
+        Crawls urls of lease, renewing it after each url.
+
+        :param lease: lease returned by coordinator
+        :return: set of urls found
+        """
+        outlinks = set()
+        for i, url in enumerate(lease['urls']):
+            if i and not self._call('renew', lease['lease_id']):
+                # lease expired and was given to another worker
+                break
+
+            try:
+                res = self.get_page_html(url)
+                if res:
+                    outlinks.update(self.find_urls(url, res.text))
+            except Exception:
+                # bad page must not stop the batch or it would be
+                # reassigned and kill next worker as well
+                logging.exception("failed to crawl {}".format(url))
+        return outlinks
+
+    def _crawl(self):
+        while not self.stop_crawler_event.is_set():
+            try:
+                lease = self._call('lease', self.worker_id, self.batch_size)
+                if lease['finished']:
+                    break
+
+                if not lease['urls']:
+                    # all partitions are busy, wait for other workers
+                    self._waiting = True
+                    self.stop_crawler_event.wait(self.poll_interval)
+                    continue
+
+                self._waiting = False
+                outlinks = self._crawl_lease(lease)
+                self._call('complete', lease['lease_id'], sorted(outlinks))
+            except (socket.error, ProtocolError):
+                logging.exception("coordinator unreachable, stopping")
+                break
+            except Fault:
+                logging.exception("coordinator error")
+                break
+
+        self.stop_crawler_event.set()
+
+
+class Worker(object):
+    """
+    Runs jobs LeaseCrawler threads against coordinator.
+    """
+    def __init__(self, coordinator, jobs=4, batch_size=0, timeout=30,
+                 token=None):
+        self.coordinator = coordinator
+
+        self.jobs = jobs
+
+        self.batch_size = batch_size
+
+        self.timeout = timeout
+
+        self.token = token
+
+        self.crawler_jobs = []
+
+        self.stop_crawler_event = Event()
+
+        self.root_url = None
+
+        self.rp = None
+
+    def start(self):
+        """
+        This method will launch crawler threads and wait until coordinator
+        reports crawl is finished.
+        :return:
+        """
+        config = get_proxy(self.coordinator, self.token).config()
+        self.root_url = urlparse(config['root_url'])
+        self.rp = get_robot_parser(self.root_url)
+
+        for i in range(0, self.jobs):
+            worker_id = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), i)
+            t = LeaseCrawler(self.coordinator,
+                             worker_id,
+                             self.root_url,
+                             self.stop_crawler_event,
+                             config['query'],
+                             config['fragment'],
+                             self.rp,
+                             self.batch_size,
+                             timeout=self.timeout,
+                             token=self.token,
+                             retry_timeout=config['lease_ttl']
+                             )
+
+            self.crawler_jobs.append(t)
+            t.start()
+
+        for job in self.crawler_jobs:
+            job.join()
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='Distributed sitemap crawler')
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.required = True
+
+    coordinator = subparsers.add_parser(
+        'coordinator', help="own frontier and serve urls to workers")
+
+    coordinator.add_argument('--domain', required=True, action="store",
+                             help="target domain (ex: http://example.com)")
+
+    coordinator.add_argument('--limit', action="store", default=1000,
+                             type=int,
+                             help="limit the no. of urls in sitemap use -1 "
+                                  "to crawl all pages of domain")
+
+    coordinator.add_argument('--query', action="store_true", default=False,
+                             help="retain query string")
+
+    coordinator.add_argument('--fragment', action="store_true",
+                             default=False, help="retain fragment")
+
+    coordinator.add_argument('--host', action="store", default='127.0.0.1',
+                             help="address to listen on for workers, xml-rpc "
+                                  "is not safe against malicious data so "
+                                  "use private interface only")
+
+    coordinator.add_argument('--port', action="store", default=8000,
+                             type=int, help="port to listen on for workers")
+
+    coordinator.add_argument('--backend', action="store", default=':memory:',
+                             help="frontier backend, sqlite file path "
+                                  "(default in memory) or redis url "
+                                  "(ex. redis://localhost:6379/0)")
+
+    coordinator.add_argument('--partitions', action="store", default=64,
+                             type=int,
+                             help="number of host hash partitions")
+
+    coordinator.add_argument('--host-concurrency', action="store",
+                             default=DEFAULT_HOST_CONCURRENCY, type=int,
+                             help="max leases per partition at once, as all "
+                                  "urls of target site share one partition "
+                                  "this is no. of batches crawled at once by "
+                                  "whole cluster (ex. workers x jobs)")
+
+    coordinator.add_argument('--lease-ttl', action="store", default=60,
+                             type=int,
+                             help="seconds after which lease of dead worker "
+                                  "is reassigned, workers renew leases "
+                                  "after each url so it must be longer than "
+                                  "worker --timeout")
+
+    coordinator.add_argument('--max-attempts', action="store",
+                             default=DEFAULT_MAX_ATTEMPTS, type=int,
+                             help="no. of times url is leased again after "
+                                  "its lease expired before giving up")
+
+    coordinator.add_argument('--batch-size', action="store", default=10,
+                             type=int, help="no. of urls in one lease")
+
+    coordinator.add_argument('--token', action="store",
+                             default=os.environ.get('CRAWLER_TOKEN'),
+                             help="shared token workers must send (default "
+                                  "CRAWLER_TOKEN environment variable)")
+
+    coordinator.add_argument('--plain', action="store_true", default=False,
+                             help="prints result as plain urls instead of "
+                                  "tree")
+
+    worker = subparsers.add_parser('worker',
+                                   help="crawl urls leased by coordinator")
+
+    worker.add_argument('--coordinator', required=True, action="store",
+                        help="coordinator url (ex: http://10.0.0.1:8000)")
+
+    worker.add_argument('--jobs', action="store", default=4, type=int,
+                        help="number of simultaneous jobs")
+
+    worker.add_argument('--timeout', action="store", default=30, type=int,
+                        help="seconds to wait for page response")
+
+    worker.add_argument('--token', action="store",
+                        default=os.environ.get('CRAWLER_TOKEN'),
+                        help="shared token of coordinator (default "
+                             "CRAWLER_TOKEN environment variable)")
+
+    args = vars(parser.parse_args())
+
+    mode = args.pop('mode')
+
+    if mode == 'worker':
+        Worker(**args).start()
+    else:
+        plain = args.pop('plain')
+        frontier = get_frontier(args.pop('backend'),
+                                partitions=args.pop('partitions'),
+                                host_concurrency=args.pop('host_concurrency'),
+                                max_attempts=args.pop('max_attempts'))
+
+        crd = Coordinator(frontier=frontier, **args)
+
+        crd.start()
+
+        s = Sitemap(crd.urls_found)
+
+        if plain:
+            s.print_plain()
+        else:
+            s.print_tree()
@@ -1,7 +1,37 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import pstats
+import tempfile
 import unittest
-from threading import Event
+from datetime import timedelta
+import multiprocessing
+from threading import Event, Thread
 from requests.utils import urlparse
-from crawler import Crawler, PageCrawler
+import requests
+import crawler
+from crawler import Crawler, PageCrawler, Profiler
+from distributed import (SqliteFrontier, RedisFrontier, Coordinator, Worker,
+                         LeaseCrawler, host_partition, get_proxy)
+
+IS_PY2 = sys.version_info < (3, 0)
+
+if IS_PY2:
+    from StringIO import StringIO
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from xmlrpclib import ProtocolError
+else:
+    from io import StringIO
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+    from xmlrpc.client import ProtocolError
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 
 class PrepareRootUrlTest(unittest.TestCase):
@@ -132,5 +162,454 @@ class IsExternalUrlTest(unittest.TestCase):
                 is_external)
 
 
+class FindUrlsTest(unittest.TestCase):
+    def test_malformed_link_skipped(self):
+        crawler = PageCrawler(
+            root_url=urlparse('https://example.com'), todo_urls=set(),
+            crawled_urls=set(), urls_found=set(), stop_crawler_event=Event())
+
+        self.assertEqual(
+            list(crawler.find_urls('https://example.com/',
+                                   '<a href="http://[oops">bad</a>'
+                                   '<a href="/about">about</a>')),
+            ['https://example.com/about'])
+
+
+class FakeResponse(object):
+    status_code = 200
+    elapsed = timedelta(seconds=0)
+    text = '<a href="/about">about</a><a href="/careers">careers</a>' \
+           '<a href="https://anotherexample.com/">external</a>'
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.profiler = Profiler()
+        self.crawler = PageCrawler(
+            root_url=urlparse('https://example.com'), todo_urls=set(),
+            crawled_urls=set(), urls_found=set(), stop_crawler_event=Event(),
+            profiler=self.profiler)
+        self.crawler._get_page = lambda url: FakeResponse()
+
+    def test_stages_recorded(self):
+        calls = []
+        self.profiler.add_hook(
+            lambda worker, stage, wall, cpu: calls.append((worker, stage)))
+
+        res = self.crawler.get_page_html('https://example.com/')
+        self.crawler.extract_urls('https://example.com/', res.text)
+
+        stats = self.profiler.stats[self.crawler.name]
+        self.assertEqual(stats['transfer'][0], 1)
+        self.assertEqual(stats['connect'][0], 1)
+        self.assertEqual(stats['parse'][0], 1)
+        self.assertEqual(stats['prepare_url'][0], 3)
+        self.assertEqual(stats['can_fetch'][0], 3)
+        self.assertEqual(stats['lock_wait'][0], 2)
+        self.assertEqual(len(calls), 11)
+        self.assertTrue(all(w == self.crawler.name for w, _ in calls))
+
+    def test_split_off(self):
+        timer = iter([10.0, 12.5, 20.0, 24.0])
+        self.addCleanup(setattr, crawler, 'default_timer',
+                        crawler.default_timer)
+        crawler.default_timer = lambda: next(timer)
+
+        with self.profiler.stage('transfer', 'w') as stage:
+            stage.split_off('connect', timedelta(seconds=1))
+
+        stats = self.profiler.stats['w']
+        self.assertEqual(stats['connect'][1], 1.0)
+        self.assertEqual(stats['transfer'][1], 1.5)
+
+        # split can not take more than wall time of the stage
+        with self.profiler.stage('transfer', 'w') as stage:
+            stage.split_off('connect', timedelta(seconds=60))
+
+        self.assertEqual(stats['connect'][1], 1.0 + 4.0)
+        self.assertEqual(stats['transfer'][1], 1.5 + 0.0)
+
+    def test_summary(self):
+        self.profiler.record('w1', 'parse', 1.0, 0.5)
+        self.profiler.record('w2', 'parse', 3.0, 1.0)
+        self.profiler.record('w1', 'transfer', 2.0, 0.1)
+
+        self.assertEqual(self.profiler.summary(),
+                         [('parse', 2, 4.0, 1.5, 3.0),
+                          ('transfer', 1, 2.0, 0.1, 2.0)])
+
+    def test_cprofile_output(self):
+        fd, output = tempfile.mkstemp(suffix='.prof')
+        os.close(fd)
+        self.addCleanup(os.remove, output)
+
+        profiler = Profiler(sampler='cprofile', output=output)
+        stop_crawler_event = Event()
+        jobs = [PageCrawler(root_url=urlparse('https://example.com'),
+                            todo_urls=set(), crawled_urls=set(),
+                            urls_found=set(),
+                            stop_crawler_event=stop_crawler_event,
+                            profiler=profiler) for _ in range(4)]
+        self.addCleanup(stop_crawler_event.set)
+
+        profiler.start()
+        for job in jobs:
+            job.start()
+
+        # all threads keep waiting for urls until stopped
+        deadline = time.time() + 10
+        while not all(job.is_waiting for job in jobs) and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(all(job.is_alive() for job in jobs))
+
+        stop_crawler_event.set()
+        for job in jobs:
+            job.join()
+        profiler.stop()
+
+        self.assertEqual(sorted(profiler.stats),
+                         sorted(job.name for job in jobs))
+        self.assertTrue(any(func[2] == '_crawl'
+                            for func in pstats.Stats(output).stats))
+
+    def test_idle_recorded_once(self):
+        self.crawler.start()
+        deadline = time.time() + 10
+        while not self.crawler.is_waiting and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.crawler.stop_crawler_event.set()
+        self.crawler.join()
+
+        # busy polling of empty todo urls is one idle period, not lock_wait
+        stats = self.profiler.stats[self.crawler.name]
+        self.assertEqual(list(stats), ['idle'])
+        self.assertEqual(stats['idle'][0], 1)
+        self.assertGreater(stats['idle'][1], 0.0)
+
+    def test_failed_request_recorded_as_error(self):
+        def get_page(url):
+            raise requests.exceptions.ConnectionError(url)
+        self.crawler._get_page = get_page
+
+        self.assertIsNone(self.crawler.get_page_html('https://example.com/'))
+
+        stats = self.profiler.stats[self.crawler.name]
+        self.assertEqual(list(stats), ['error'])
+        self.assertEqual(stats['error'][0], 1)
+
+    def test_no_output_written(self):
+        profiler = Profiler(sampler='stack', output='never-written.stacks')
+        profiler.start()
+        profiler.stop()
+
+        self.assertFalse(os.path.exists('never-written.stacks'))
+        stdout = sys.stdout
+        sys.stdout = out = StringIO()
+        try:
+            profiler.print_summary()
+        finally:
+            sys.stdout = stdout
+        self.assertNotIn('written', out.getvalue())
+
+    def test_invalid_sampler(self):
+        self.assertRaises(ValueError, Profiler, sampler='perf')
+
+
+class SqliteFrontierTest(unittest.TestCase):
+    def get_frontier(self, host_concurrency=1, max_attempts=3):
+        return SqliteFrontier(partitions=8, host_concurrency=host_concurrency,
+                              max_attempts=max_attempts)
+
+    def test_dedup(self):
+        frontier = self.get_frontier()
+        self.assertEqual(frontier.add(['https://example.com/a',
+                                       'https://example.com/b',
+                                       'https://example.com/a']), 2)
+        self.assertEqual(frontier.add(['https://example.com/b',
+                                       'https://example.com/c',
+                                       'https://example.com/d'],
+                                      max_new=1), 1)
+        self.assertEqual(frontier.urls(), ['https://example.com/a',
+                                           'https://example.com/b',
+                                           'https://example.com/c'])
+
+    def test_lease_partitioned_by_host(self):
+        frontier = self.get_frontier()
+        urls = ['https://example.com/a', 'https://other.com/a',
+                'https://example.com/b']
+        frontier.add(urls)
+
+        lease_id, leased = frontier.lease('w1', 10, 60)
+        self.assertEqual(leased, ['https://example.com/a',
+                                  'https://example.com/b'])
+
+        # example.com partition is busy, only other host can be leased
+        _, other = frontier.lease('w2', 10, 60)
+        self.assertEqual(other, ['https://other.com/a'])
+        self.assertEqual(frontier.lease('w3', 10, 60), (None, []))
+
+        self.assertTrue(frontier.complete(lease_id))
+        self.assertFalse(frontier.complete(lease_id))
+
+    def test_host_concurrency(self):
+        frontier = self.get_frontier(host_concurrency=2)
+        frontier.add(['https://example.com/{}'.format(i) for i in range(5)])
+
+        self.assertEqual(len(frontier.lease('w1', 2, 60)[1]), 2)
+        self.assertEqual(len(frontier.lease('w2', 2, 60)[1]), 2)
+        self.assertEqual(frontier.lease('w3', 2, 60), (None, []))
+        self.assertEqual(frontier.leased(), 2)
+        self.assertEqual(frontier.pending(), 1)
+
+    def test_host_partition(self):
+        self.assertEqual(host_partition('https://example.com/a', 8),
+                         host_partition('https://EXAMPLE.com/b?c=1', 8))
+        self.assertNotEqual(host_partition('https://example.com/a', 8),
+                            host_partition('https://other.com/a', 8))
+
+    def test_renew(self):
+        frontier = self.get_frontier()
+        frontier.add(['https://example.com/a'])
+
+        lease_id, _ = frontier.lease('w1', 10, 0)
+        self.assertTrue(frontier.renew(lease_id, 60))
+        self.assertEqual(frontier.reclaim(), 0)
+
+        self.assertFalse(frontier.renew('unknown', 60))
+        self.assertTrue(frontier.complete(lease_id))
+        self.assertFalse(frontier.renew(lease_id, 60))
+
+    def test_expired_lease_reassigned(self):
+        frontier = self.get_frontier()
+        frontier.add(['https://example.com/a', 'https://example.com/b'])
+
+        lease_id, urls = frontier.lease('w1', 10, 0)
+        self.assertEqual(frontier.pending(), 0)
+        self.assertEqual(frontier.reclaim(), 1)
+        self.assertEqual(frontier.pending(), 2)
+
+        new_lease_id, new_urls = frontier.lease('w2', 10, 60)
+        self.assertEqual(new_urls, urls)
+        # dead worker can not complete reassigned lease
+        self.assertFalse(frontier.complete(lease_id))
+        self.assertTrue(frontier.complete(new_lease_id))
+        self.assertEqual((frontier.pending(), frontier.leased()), (0, 0))
+
+    def test_give_up_after_max_attempts(self):
+        frontier = self.get_frontier(max_attempts=2)
+        frontier.add(['https://example.com/a', 'https://example.com/b'])
+
+        frontier.lease('w1', 1, 0)
+        self.assertEqual(frontier.reclaim(), 1)
+        self.assertEqual(frontier.pending(), 2)
+
+        # second expiry of same url, it's not leased again
+        self.assertEqual(frontier.lease('w2', 1, 0)[1],
+                         ['https://example.com/a'])
+        self.assertEqual(frontier.reclaim(), 1)
+        self.assertEqual(frontier.pending(), 1)
+        self.assertEqual(frontier.lease('w3', 10, 60)[1],
+                         ['https://example.com/b'])
+        self.assertEqual(frontier.found(), 2)
+
+
+class SqliteFrontierResumeTest(unittest.TestCase):
+    def test_counters_restored(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        frontier = SqliteFrontier(path)
+        frontier.add(['https://example.com/{}'.format(i) for i in range(3)])
+        lease_id, _ = frontier.lease('w1', 2, 60)
+        frontier.complete(lease_id)
+        frontier.db.close()
+
+        frontier = SqliteFrontier(path)
+        self.assertEqual((frontier.found(), frontier.pending()), (3, 1))
+
+
+@unittest.skipUnless(fakeredis, "fakeredis is not installed")
+class RedisFrontierTest(SqliteFrontierTest):
+    def get_frontier(self, host_concurrency=1, max_attempts=3):
+        return RedisFrontier(fakeredis.FakeStrictRedis(), partitions=8,
+                             host_concurrency=host_concurrency,
+                             max_attempts=max_attempts)
+
+
+class FakeCoordinator(object):
+    def __init__(self, urls, renewals, failures=0):
+        self.leases = [{'lease_id': 'l1', 'urls': urls, 'finished': False},
+                       {'lease_id': '', 'urls': [], 'finished': True}]
+        self.renewals = list(renewals)
+        self.completed = []
+        # no. of lease calls failing as if coordinator was down
+        self.failures = failures
+
+    def lease(self, worker_id, batch_size):
+        if self.failures:
+            self.failures -= 1
+            raise socket.error("connection refused")
+        return self.leases.pop(0)
+
+    def renew(self, lease_id):
+        return self.renewals.pop(0)
+
+    def complete(self, lease_id, outlinks):
+        self.completed.append((lease_id, outlinks))
+        return True
+
+
+class LeaseCrawlerTest(unittest.TestCase):
+    def test_stop_batch_when_lease_lost(self):
+        fetched = []
+        crawler = LeaseCrawler('http://127.0.0.1:1', 'w1',
+                               urlparse('https://example.com'), Event())
+        crawler.coordinator = FakeCoordinator(
+            ['https://example.com/{}'.format(i) for i in range(4)],
+            [True, False])
+        crawler._get_page = lambda url: fetched.append(url) or FakeResponse()
+
+        crawler.run()
+
+        # lease was renewed before second url and lost before third
+        self.assertEqual(fetched, ['https://example.com/0',
+                                   'https://example.com/1'])
+        self.assertEqual(crawler.coordinator.completed,
+                         [('l1', ['https://example.com/about',
+                                  'https://example.com/careers'])])
+        self.assertTrue(crawler.stop_crawler_event.is_set())
+
+    def test_bad_page_does_not_stop_batch(self):
+        def get_page(url):
+            if url.endswith('bad'):
+                raise RuntimeError('unexpected error')
+            return FakeResponse()
+
+        crawler = LeaseCrawler('http://127.0.0.1:1', 'w1',
+                               urlparse('https://example.com'), Event())
+        crawler.coordinator = FakeCoordinator(
+            ['https://example.com/bad', 'https://example.com/good'],
+            [True])
+        crawler._get_page = get_page
+
+        crawler.run()
+
+        self.assertEqual(crawler.coordinator.completed,
+                         [('l1', ['https://example.com/about',
+                                  'https://example.com/careers'])])
+
+    def test_retry_while_coordinator_unreachable(self):
+        crawler = LeaseCrawler('http://127.0.0.1:1', 'w1',
+                               urlparse('https://example.com'), Event(),
+                               retry_timeout=10, retry_interval=0.01)
+        crawler.coordinator = FakeCoordinator(['https://example.com/0'], [],
+                                              failures=3)
+        crawler._get_page = lambda url: FakeResponse()
+
+        crawler.run()
+
+        self.assertEqual(crawler.coordinator.failures, 0)
+        self.assertEqual(len(crawler.coordinator.completed), 1)
+
+    def test_stop_when_coordinator_gone(self):
+        crawler = LeaseCrawler('http://127.0.0.1:1', 'w1',
+                               urlparse('https://example.com'), Event(),
+                               retry_timeout=0.1, retry_interval=0.01)
+        crawler.coordinator = FakeCoordinator(['https://example.com/0'], [],
+                                              failures=sys.maxsize)
+
+        crawler.run()
+
+        self.assertEqual(crawler.coordinator.completed, [])
+        self.assertTrue(crawler.stop_crawler_event.is_set())
+
+
+def run_worker(coordinator_url, token):
+    Worker(coordinator_url, jobs=2, batch_size=2, token=token).start()
+
+
+@unittest.skipIf(IS_PY2, "needs multiprocessing spawn context")
+class DistributedCrawlTest(unittest.TestCase):
+    def setUp(self):
+        # site with 10 pages, each page links to next and first page and
+        # has malformed link
+        self.site = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.site)
+        for i in range(10):
+            with open(os.path.join(self.site, 'p{}.html'.format(i)), 'w') as f:
+                f.write('<a href="/p{}.html">next</a><a href="/p0.html">first'
+                        '</a><a href="http://[oops">bad</a>'.format(i + 1))
+
+        site = self.site
+
+        class Handler(SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                return os.path.join(site, path.lstrip('/') or 'p0.html')
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        t = Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+
+    def get_coordinator(self, **kwargs):
+        coordinator = Coordinator(
+            'http://127.0.0.1:{}'.format(self.httpd.server_address[1]),
+            port=0, **kwargs)
+        coordinator.bind()
+        self.addCleanup(coordinator.stop_coordinator_event.set)
+        return coordinator
+
+    def test_crawl_with_worker_processes(self):
+        coordinator = self.get_coordinator(limit=-1, token='secret')
+        t = Thread(target=coordinator.start)
+        t.daemon = True
+        t.start()
+
+        # spawn so workers don't inherit server sockets and locks of this
+        # process, like workers on other nodes
+        ctx = multiprocessing.get_context('spawn')
+        workers = [ctx.Process(target=run_worker,
+                               args=(coordinator.url, 'secret'))
+                   for _ in range(2)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+            self.addCleanup(w.terminate)
+
+        t.join(60)
+        for w in workers:
+            w.join(60)
+
+        self.assertFalse(t.is_alive())
+        self.assertEqual(
+            sorted(urlparse(url).path for url in coordinator.urls_found),
+            sorted([''] + ['/p{}.html'.format(i) for i in range(11)]))
+
+    def test_token_required(self):
+        coordinator = self.get_coordinator(token='secret')
+        t = Thread(target=coordinator.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.addCleanup(coordinator.server.server_close)
+        self.addCleanup(coordinator.server.shutdown)
+
+        for token in (None, 'wrong'):
+            with self.assertRaises(ProtocolError) as cm:
+                get_proxy(coordinator.url, token).config()
+            self.assertEqual(cm.exception.errcode, 401)
+
+        config = get_proxy(coordinator.url, 'secret').config()
+        self.assertEqual(config['root_url'],
+                         coordinator.crawler.root_url.geturl())
+
+
 if __name__ == '__main__':
     unittest.main()